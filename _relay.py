@@ -0,0 +1,74 @@
+"""Décodage et encodage des trames du relais, isolés de la partie asynchrone.
+
+Le module est annoté pour mypyc : il s'importe tel quel en Python, et
+`mypyc _relay.py` en produit une extension compilée qui le remplace sans
+changement d'API. Les valeurs venant du client restent typées Any : un JSON
+inattendu ne doit pas lever d'erreur de type dans la version compilée.
+"""
+import re
+import struct
+from typing import Any
+
+import msgpack  # type: ignore[import-untyped]
+import orjson
+
+# Trame binaire compacte de l'état du joueur : x, y (int16), santé (uint8).
+# Elle ne concerne que le Joueur 1 : de lui, une trame binaire de 5 octets est
+# toujours une position. Les messages du Spectre sont toujours du MessagePack.
+POSITION_FRAME = struct.Struct("<hhB")
+
+# Forme exacte d'une mise à jour JSON du Joueur 1, lue sans construire de dict :
+# {"player_pos": [x, y], "health": h} avec des entiers. Le motif est ancré et sans
+# répétition ambiguë (temps linéaire) ; les trames plus longues que
+# PLAYER_STATE_FAST_MAX et toute autre forme (flottants, autres clés, autre ordre...)
+# passent par orjson.
+PLAYER_STATE_FAST_MAX = 128
+# Les entiers suivent la grammaire JSON (pas de zéro en tête comme 007) : le
+# raccourci n'accepte aucune trame que orjson refuserait.
+_INT = r"(-?(?:0|[1-9][0-9]*))"
+PLAYER_STATE_PATTERN = re.compile(
+    r'\{[ \t\n\r]*"player_pos"[ \t\n\r]*:[ \t\n\r]*'
+    r'\[[ \t\n\r]*' + _INT + r'[ \t\n\r]*,[ \t\n\r]*' + _INT + r'[ \t\n\r]*\][ \t\n\r]*,[ \t\n\r]*'
+    r'"health"[ \t\n\r]*:[ \t\n\r]*' + _INT + r'[ \t\n\r]*\}'
+)
+PLAYER_STATE_PATTERN_BYTES = re.compile(PLAYER_STATE_PATTERN.pattern.encode())
+
+def decode_binary(data: bytes) -> Any:
+    """Décode une trame binaire MessagePack."""
+    return msgpack.unpackb(data, use_list=False)
+
+def parse_player_state(frame: str | bytes, binary: bool) -> tuple | None:
+    """Lit une mise à jour du Joueur 1 sous la forme (x, y, santé).
+
+    Une trame texte est toujours lue comme du JSON, quel que soit l'encodage.
+    Renvoie None si le message n'a pas la forme attendue.
+    """
+    message: Any
+    match: Any
+    if binary and isinstance(frame, bytes):
+        if len(frame) == POSITION_FRAME.size:
+            return POSITION_FRAME.unpack(frame)
+        message = msgpack.unpackb(frame, use_list=False)
+    else:
+        if len(frame) > PLAYER_STATE_FAST_MAX:
+            match = None
+        elif isinstance(frame, str):
+            match = PLAYER_STATE_PATTERN.fullmatch(frame)
+        else:
+            match = PLAYER_STATE_PATTERN_BYTES.fullmatch(frame)
+        if match:
+            return int(match[1]), int(match[2]), int(match[3])
+        message = orjson.loads(frame)
+    if not isinstance(message, dict):
+        return None
+    player_pos = message.get("player_pos", (0, 0))
+    if not isinstance(player_pos, (list, tuple)) or len(player_pos) != 2:
+        return None
+    return player_pos[0], player_pos[1], message.get("health", 100)
+
+def encode_player_state(player_pos: Any, health: Any) -> bytes:
+    """Encode l'état du joueur en trame compacte, ou en MessagePack si hors bornes."""
+    try:
+        return POSITION_FRAME.pack(*player_pos, health)
+    except struct.error:
+        return msgpack.packb({"type": "player_state", "player_pos": player_pos, "health": health})
@@ -1,15 +1,221 @@
+from _relay import decode_binary, encode_player_state, parse_player_state
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-import json
+import asyncio
+import logging
+import logging.handlers
+import msgpack  # type: ignore[import-untyped]
+import orjson
+import os
+import queue
+import re
+import time
 import uuid
 
 # --- CONSTANTES --- #
 ERROR_INVALID_CLIENT_TYPE = "Type de client invalide."
 ERROR_INVALID_SESSION = "Session ID invalide ou terminée."
 ERROR_SPECTRE_ALREADY_CONNECTED = "Un Spectre est déjà connecté à cette session."
+ERROR_SERVER_FULL = "Serveur complet, réessayez plus tard."
+
+# Identifiant de session "NX-1234", stocké sous forme d'entier (1234)
+SESSION_ID_PATTERN = re.compile(r"NX-([0-9]{4})", re.IGNORECASE)
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+OUTBOX_SIZE = 64  # Trames en attente par client avant d'abandonner les plus anciennes
+SEND_TIMEOUT = 5.0  # Secondes avant de considérer un client comme bloqué
+MAX_SESSIONS = 1000  # Sessions simultanées avant de refuser les nouvelles parties
+SESSION_IDLE_TIMEOUT = 600.0  # Secondes sans message avant d'abandonner une session
+SESSION_SWEEP_INTERVAL = 60.0  # Secondes entre deux recherches de sessions inactives
+LOG_QUEUE_SIZE = 10000  # Enregistrements en attente avant d'abandonner les nouveaux
+
+# --- Journalisation --- #
+# Les enregistrements passent par une file et sont écrits par un thread dédié :
+# la boucle d'événements n'attend jamais stdout. La file est bornée : si le thread
+# ne suit pas (ou ne tourne pas, avec --lifespan off), les enregistrements en trop
+# sont perdus. Les connexions, déconnexions et rejets de connexion sont en DEBUG ;
+# NEXUS_LOG_LEVEL=DEBUG les réaffiche.
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler qui abandonne l'enregistrement quand la file est pleine."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+class BoundedQueueListener(logging.handlers.QueueListener):
+    """QueueListener dont l'arrêt attend une place dans la file bornée."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("NEXUS_LOG_LEVEL", "WARNING").upper())
+logger.propagate = False
+_log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+logger.addHandler(DroppingQueueHandler(_log_queue))
+_log_listener = BoundedQueueListener(_log_queue, logging.StreamHandler())
+
+# --- Encodage des messages --- #
+# Par défaut les clients échangent des trames texte JSON. Avec ?encoding=msgpack,
+# ils échangent des trames binaires : MessagePack pour tous les messages, sauf
+# l'état du joueur qui tient dans une trame compacte de 5 octets (x, y, santé).
+# En JSON, le client peut aussi envoyer ses messages en trames binaires : orjson
+# les lit directement, sans le décodage UTF-8 qu'impose une trame texte.
+# Le décodage et l'encodage des trames vivent dans _relay (compilable avec mypyc).
+
+# Erreurs de décodage ou d'encodage d'une trame : la trame est ignorée, la
+# connexion continue (MessagePack invalide, JSON invalide, valeur non sérialisable
+# dans l'encodage du pair...).
+FRAME_ERRORS = (ValueError, TypeError, OverflowError, msgpack.UnpackException)
+
+def static_payload(message: dict) -> tuple[str, bytes]:
+    """Pré-sérialise un message constant dans les deux encodages."""
+    return orjson.dumps(message).decode(), msgpack.packb(message)
+
+async def receive_frame(websocket: WebSocket) -> str | bytes:
+    """Reçoit la prochaine trame du client, texte ou binaire, telle quelle."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    text = message.get("text")
+    return text if text is not None else message["bytes"]
+
+async def receive_message(websocket: WebSocket) -> dict:
+    """Reçoit et décode le prochain message du client."""
+    frame = await receive_frame(websocket)
+    if websocket.state.binary and isinstance(frame, bytes):
+        return decode_binary(frame)
+    return orjson.loads(frame)
+
+async def receive_player_state(websocket: WebSocket) -> tuple | None:
+    """Reçoit la prochaine mise à jour du Joueur 1 sous la forme (x, y, santé), ou None."""
+    return parse_player_state(await receive_frame(websocket), websocket.state.binary)
+
+@dataclass(slots=True)
+class PlayerState:
+    """Dernier état connu du joueur, sérialisé tel quel par orjson."""
+    type: str = "player_state"
+    player_pos: tuple = (0, 0)
+    health: int = 100
+
+def encode_message(websocket: WebSocket, message: dict) -> str | bytes:
+    """Sérialise un message dans l'encodage choisi par le client."""
+    if websocket.state.binary:
+        return msgpack.packb(message)
+    return orjson.dumps(message).decode()
+
+async def send_static(websocket: WebSocket, payload: tuple[str, bytes]):
+    """Envoie directement un message pré-sérialisé (hors file d'envoi)."""
+    if websocket.state.binary:
+        await websocket.send_bytes(payload[1])
+    else:
+        await websocket.send_text(payload[0])
+
+# --- File d'envoi par client --- #
+# Chaque WebSocket possède une file bornée vidée par sa propre tâche d'écriture :
+# la boucle de lecture d'un client n'attend jamais l'envoi vers son pair. Si le
+# pair est trop lent et que sa file est pleine, la trame la plus ancienne est perdue.
+# L'état du joueur n'est pas empilé : seul le plus récent compte pour le Spectre.
+# Il est conservé dans un emplacement unique, écrasé à chaque mise à jour, et un
+# marqueur le représente dans la file tant qu'il n'a pas été envoyé.
+# Un second marqueur demande la fermeture une fois les trames précédentes envoyées.
+
+_STATE_PENDING = object()
+_CLOSE = object()
+
+def queue_frame(websocket: WebSocket, frame: object):
+    """Ajoute une trame (str, bytes ou marqueur) à la file d'envoi du client."""
+    outbox = websocket.state.outbox
+    try:
+        outbox.put_nowait(frame)
+    except asyncio.QueueFull:
+        if outbox.get_nowait() is _STATE_PENDING:
+            websocket.state.pending_state = None
+        outbox.put_nowait(frame)
+
+def queue_static(websocket: WebSocket, payload: tuple[str, bytes]):
+    """Ajoute un message pré-sérialisé à la file d'envoi du client."""
+    queue_frame(websocket, payload[1] if websocket.state.binary else payload[0])
+
+def queue_state(websocket: WebSocket, frame: str | bytes):
+    """Remplace l'état du joueur en attente d'envoi par le plus récent."""
+    already_queued = websocket.state.pending_state is not None
+    websocket.state.pending_state = frame
+    if not already_queued:
+        queue_frame(websocket, _STATE_PENDING)
+
+def queue_message(websocket: WebSocket, message: dict):
+    """Sérialise un message et l'ajoute à la file d'envoi du client."""
+    queue_frame(websocket, encode_message(websocket, message))
+
+def broadcast_state(viewers, state: PlayerState):
+    """Transmet l'état du joueur aux spectateurs, sérialisé une seule fois par encodage."""
+    text = packed = None
+    for viewer in viewers:
+        if viewer.state.binary:
+            if packed is None:
+                packed = encode_player_state(state.player_pos, state.health)
+            queue_state(viewer, packed)
+        else:
+            if text is None:
+                text = orjson.dumps(state).decode()
+            queue_state(viewer, text)
+
+async def outbox_writer(websocket: WebSocket):
+    """Tâche d'écriture : vide la file d'envoi du client vers sa WebSocket."""
+    outbox = websocket.state.outbox
+    try:
+        while True:
+            frame = await outbox.get()
+            if frame is _CLOSE:
+                # La fermeture réveille la boucle de lecture du client, qui se termine
+                async with asyncio.timeout(SEND_TIMEOUT):
+                    await websocket.close(code=1000)
+                return
+            if frame is _STATE_PENDING:
+                frame = websocket.state.pending_state
+                websocket.state.pending_state = None
+            async with asyncio.timeout(SEND_TIMEOUT):
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(frame)
+    except TimeoutError:
+        # Client bloqué : la fermeture réveille sa boucle de lecture, qui nettoie la session
+        logger.warning("Client bloqué depuis %ss, fermeture de la connexion", SEND_TIMEOUT)
+        try:
+            async with asyncio.timeout(SEND_TIMEOUT):
+                await websocket.close(code=1008)
+        except (TimeoutError, RuntimeError, OSError):
+            pass
+    except (WebSocketDisconnect, RuntimeError, OSError):
+        pass  # Connexion fermée : la boucle de lecture gère la déconnexion
+
+# --- Messages constants pré-sérialisés (aucun encodage à l'envoi) --- #
+_ERR_INVALID_SESSION = static_payload({"type": "error", "message": ERROR_INVALID_SESSION})
+_ERR_SPECTRE_ALREADY_CONNECTED = static_payload({"type": "error", "message": ERROR_SPECTRE_ALREADY_CONNECTED})
+_ERR_SERVER_FULL = static_payload({"type": "error", "message": ERROR_SERVER_FULL})
+_MSG_SPECTRE_CONNECTED = static_payload({"type": "spectre_status", "status": "connected"})
+_MSG_SPECTRE_DISCONNECTED = static_payload({"type": "spectre_status", "status": "disconnected"})
+_MSG_GAME_OVER = static_payload({"type": "game_over", "message": "Le joueur principal a quitté la partie."})
 
 # --- CONFIGURATION --- #
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Démarre et arrête le thread des journaux et le nettoyage des sessions."""
+    _log_listener.start()
+    sweeper = asyncio.create_task(sweep_idle_sessions())
+    yield
+    sweeper.cancel()
+    _log_listener.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # --- Configuration CORS --- #
 origins = ["*"]  # Autorise toutes les origines (À restreindre en production)
@@ -23,7 +229,25 @@ app.add_middleware(
 )
 
 # --- Stockage des Sessions --- #
-active_sessions = {}
+# Les sessions vivent dans la mémoire du processus : le Joueur 1 et son Spectre
+# doivent atteindre le même processus, le serveur tourne donc avec un seul worker.
+# Toutes les mutations se font sur la boucle d'événements, sans await entre la
+# lecture et l'écriture d'une session : aucun verrou n'est nécessaire.
+class Session:
+    """État d'une partie : les deux clients et le dernier état connu du joueur."""
+    __slots__ = ("player1", "spectre", "player_state", "last_seen")
+
+    def __init__(self, player1: WebSocket):
+        self.player1: WebSocket | None = player1
+        self.spectre: WebSocket | None = None
+        self.player_state = PlayerState()
+        self.last_seen = time.monotonic()
+
+active_sessions: dict[int, Session] = {}  # Clé : numéro de session
+# Clients dont la session a été retirée mais dont la déconnexion n'est pas encore
+# arrivée (clé : WebSocket, valeur : instant du retrait). Ils occupent toujours une
+# place de connexion : le balayage termine ceux dont la fermeture n'aboutit pas.
+detached_clients: dict[WebSocket, float] = {}
 
 # --- Point d'entrée pour vérifier la santé du serveur --- #
 @app.get("/")
@@ -33,107 +257,201 @@ def read_root():
 
 # --- GESTION DES WEBSOCKETS --- #
 
-async def handle_player1_connection(websocket: WebSocket, session_id: str):
+async def handle_player1_connection(websocket: WebSocket, session_id: int):
     """Gère la connexion du Joueur 1 et crée la session si nécessaire."""
+    if session_id not in active_sessions and len(active_sessions) >= MAX_SESSIONS:
+        logger.debug("Connexion rejetée: limite de %d sessions atteinte", MAX_SESSIONS)
+        await send_static(websocket, _ERR_SERVER_FULL)
+        await websocket.close(code=1013)
+        return False
+
     if session_id not in active_sessions:
-        active_sessions[session_id] = {
-            "player1": websocket,
-            "spectre": None,
-            "state": {"player_pos": [0, 0], "spectre_action": None}
-        }
-        print(f"Session {session_id} créée par Joueur 1.")
+        active_sessions[session_id] = Session(websocket)
+        logger.debug("Session NX-%04d créée par Joueur 1.", session_id)
     else:
-        active_sessions[session_id]["player1"] = websocket
-        print(f"Joueur 1 reconnecté à la session {session_id}")
+        active_sessions[session_id].player1 = websocket
+        logger.debug("Joueur 1 reconnecté à la session NX-%04d", session_id)
+    return True
 
-async def handle_spectre_connection(websocket: WebSocket, session_id: str):
+async def handle_spectre_connection(websocket: WebSocket, session_id: int):
     """Gère la connexion du Spectre à une session existante."""
     session = active_sessions.get(session_id)
     if session is None:
-        await websocket.send_text(json.dumps({"type": "error", "message": ERROR_INVALID_SESSION}))
-        return await websocket.close(code=1008)
+        await send_static(websocket, _ERR_INVALID_SESSION)
+        await websocket.close(code=1008)
+        return False
 
-    if session["spectre"] is not None:
-        await websocket.send_text(json.dumps({"type": "error", "message": ERROR_SPECTRE_ALREADY_CONNECTED}))
-        return await websocket.close(code=1008)
+    if session.spectre is not None:
+        await send_static(websocket, _ERR_SPECTRE_ALREADY_CONNECTED)
+        await websocket.close(code=1008)
+        return False
 
-    session["spectre"] = websocket
-    print(f"Spectre connecté à la session {session_id}")
+    session.spectre = websocket
+    logger.debug("Spectre connecté à la session NX-%04d", session_id)
 
     # Notifie le Joueur 1 que le Spectre est connecté
-    if session["player1"]:
-        await session["player1"].send_text(json.dumps({"type": "spectre_status", "status": "connected"}))
+    if session.player1:
+        queue_static(session.player1, _MSG_SPECTRE_CONNECTED)
+    return True
 
-async def handle_client_messages(websocket: WebSocket, session_id: str, client_type: str):
+async def handle_client_messages(websocket: WebSocket, session_id: int, client_type: str):
     """Boucle pour la réception et l'envoi des messages entre clients et serveur."""
     session = active_sessions[session_id]
+    # Les recherches constantes sont faites une fois, hors des boucles ; seul le
+    # pair est relu à chaque message, car il change quand l'autre client (dé)connecte.
+    monotonic = time.monotonic
     try:
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-
-            if client_type == 'player1':
-                # Met à jour la position du joueur et envoie au Spectre
-                session["state"]["player_pos"] = message.get("player_pos", [0, 0])
-                if session["spectre"]:
-                    await session["spectre"].send_text(json.dumps({
-                        "type": "player_state", 
-                        "player_pos": session["state"]["player_pos"],
-                        "health": message.get("health", 100)
-                    }))
-            elif client_type == 'spectre':
-                # Envoie l'action du Spectre au Joueur 1
-                action = message.get("action")
-                data_action = message.get("data", {})
-                if session["player1"]:
-                    await session["player1"].send_text(json.dumps({
-                        "type": "spectre_action", 
-                        "action": action, 
-                        "data": data_action
-                    }))
+        if client_type == 'player1':
+            # Met à jour la position du joueur et envoie au Spectre
+            state = session.player_state
+            receive_state = receive_player_state
+            broadcast = broadcast_state
+            while True:
+                try:
+                    update = await receive_state(websocket)
+                    if update is None:
+                        continue
+                    x, y, state.health = update
+                    state.player_pos = (x, y)
+                    session.last_seen = monotonic()
+                    spectre = session.spectre
+                    if spectre:
+                        broadcast((spectre,), state)
+                except FRAME_ERRORS:
+                    logger.debug("Trame invalide ignorée (session NX-%04d)", session_id)
+        elif client_type == 'spectre':
+            # Envoie l'action du Spectre au Joueur 1
+            receive_action = receive_message
+            while True:
+                try:
+                    message = await receive_action(websocket)
+                    if not isinstance(message, dict):
+                        continue
+                    session.last_seen = monotonic()
+                    get = message.get
+                    player1 = session.player1
+                    if player1:
+                        queue_message(player1, {
+                            "type": "spectre_action", 
+                            "action": get("action"), 
+                            "data": get("data", {})
+                        })
+                except FRAME_ERRORS:
+                    logger.debug("Trame invalide ignorée (session NX-%04d)", session_id)
     except WebSocketDisconnect:
-        print(f"Client {client_type} déconnecté de la session {session_id}")
+        logger.debug("Client %s déconnecté de la session NX-%04d", client_type, session_id)
+    finally:
+        # Toute fin de boucle, même sur une erreur inattendue, libère la place du client
+        detached_clients.pop(websocket, None)
         if client_type == 'player1':
-            await handle_player1_disconnection(session_id)
+            await handle_player1_disconnection(session_id, session)
         elif client_type == 'spectre':
-            await handle_spectre_disconnection(session_id)
+            await handle_spectre_disconnection(session_id, session)
+
+# Les deux gestionnaires ne touchent qu'à la session du client : si elle a été
+# fermée pour inactivité, le numéro peut déjà appartenir à une nouvelle partie.
 
-async def handle_player1_disconnection(session_id: str):
+async def handle_player1_disconnection(session_id: int, session: Session):
     """Gère la déconnexion de Joueur 1."""
-    session = active_sessions.pop(session_id, None)
-    if session and session["spectre"]:
-        await session["spectre"].send_text(json.dumps({"type": "game_over", "message": "Le joueur principal a quitté la partie."}))
+    if active_sessions.get(session_id) is session:
+        del active_sessions[session_id]
+        # La partie est finie : le Spectre reçoit game_over puis est déconnecté,
+        # ses actions suivantes n'ont plus de destinataire.
+        session.player1 = None
+        if session.spectre:
+            queue_static(session.spectre, _MSG_GAME_OVER)
+            queue_frame(session.spectre, _CLOSE)
+            detached_clients[session.spectre] = time.monotonic()
 
-async def handle_spectre_disconnection(session_id: str):
+async def handle_spectre_disconnection(session_id: int, session: Session):
     """Gère la déconnexion du Spectre."""
-    session = active_sessions.get(session_id)
-    if session:
-        session["spectre"] = None
-        if session["player1"]:
-            await session["player1"].send_text(json.dumps({"type": "spectre_status", "status": "disconnected"}))
+    if active_sessions.get(session_id) is session:
+        session.spectre = None
+        if session.player1:
+            queue_static(session.player1, _MSG_SPECTRE_DISCONNECTED)
+
+async def sweep_idle_sessions():
+    """Tâche de fond : ferme les sessions sans message depuis SESSION_IDLE_TIMEOUT.
+
+    Couvre les connexions à moitié ouvertes, dont la déconnexion n'arrive jamais,
+    y compris celles des clients déjà retirés de leur session.
+    """
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        now = time.monotonic()
+        # Retirés depuis un intervalle complet sans que leur fermeture aboutisse :
+        # la boucle de lecture est annulée, ce qui rend la connexion.
+        stale = now - SESSION_SWEEP_INTERVAL
+        for websocket, detached_at in list(detached_clients.items()):
+            if detached_at < stale:
+                del detached_clients[websocket]
+                websocket.state.reader.cancel()
+        deadline = now - SESSION_IDLE_TIMEOUT
+        idle = [session_id for session_id, session in active_sessions.items() if session.last_seen < deadline]
+        for session_id in idle:
+            # Les fermetures précédentes attendent : la session a pu se terminer
+            # ou le numéro être repris par une nouvelle partie entre-temps.
+            session = active_sessions.get(session_id)
+            if session is None or session.last_seen >= deadline:
+                continue
+            del active_sessions[session_id]
+            logger.warning("Session NX-%04d inactive, fermeture", session_id)
+            for websocket in (session.player1, session.spectre):
+                if websocket:
+                    detached_clients[websocket] = now
+                    try:
+                        async with asyncio.timeout(SEND_TIMEOUT):
+                            await websocket.close(code=1001)
+                    except (TimeoutError, RuntimeError, OSError):
+                        pass
 
 @app.websocket("/ws/{session_id}/{client_type}")
-async def websocket_endpoint(websocket: WebSocket, session_id: str, client_type: str):
+async def websocket_endpoint(websocket: WebSocket, session_id: str, client_type: str, encoding: str = ENCODING_JSON):
     """Endpoint principal pour la gestion des connexions WebSocket."""
-    session_id = session_id.upper()
+    # Validation de l'identifiant de session
+    match = SESSION_ID_PATTERN.fullmatch(session_id)
+    if match is None:
+        logger.debug("Connexion rejetée: Session ID invalide '%s'", session_id)
+        return await websocket.close(code=1008)
+    sid = int(match[1])
+    websocket.state.binary = encoding == ENCODING_MSGPACK
 
     # Validation du type de client
     if client_type not in ["player1", "spectre"]:
-        print(f"Connexion rejetée: Type de client invalide '{client_type}'")
+        logger.debug("Connexion rejetée: Type de client invalide '%s'", client_type)
         return await websocket.close(code=1008)  # Code non valide
 
     # Accepte la connexion WebSocket
+    websocket.state.outbox = asyncio.Queue(maxsize=OUTBOX_SIZE)
+    websocket.state.pending_state = None
     await websocket.accept()
 
     if client_type == 'player1':
-        await handle_player1_connection(websocket, session_id)
+        connected = await handle_player1_connection(websocket, sid)
     elif client_type == 'spectre':
-        await handle_spectre_connection(websocket, session_id)
+        connected = await handle_spectre_connection(websocket, sid)
+    if not connected:
+        return
 
-    # Gère les messages du client
-    await handle_client_messages(websocket, session_id, client_type)
+    # Gère les messages du client, les envois passant par sa tâche d'écriture
+    # La boucle de lecture est une tâche distincte pour que le balayage puisse
+    # l'annuler sans interrompre le point d'entrée.
+    writer = asyncio.create_task(outbox_writer(websocket))
+    reader = asyncio.create_task(handle_client_messages(websocket, sid, client_type))
+    websocket.state.reader = reader
+    try:
+        await asyncio.wait((reader,))
+    finally:
+        reader.cancel()
+        writer.cancel()
+    if not reader.cancelled():
+        reader.result()  # Propage une erreur inattendue de la boucle de lecture
 
 # --- Démarrage du serveur (local uniquement) --- #
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("server:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run(
+        "server:app", host="0.0.0.0", port=8000,  # uvloop et httptools choisis s'ils sont installés
+        limit_concurrency=2 * MAX_SESSIONS + 100,  # Joueur 1 + Spectre par session, plus une marge
+        backlog=1024,
+    )